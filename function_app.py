@@ -1,8 +1,15 @@
+import io
 import os
+import time
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import orjson
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from azure.storage.blob import BlobServiceClient
 import logging
 from pytz import timezone
@@ -19,13 +26,29 @@ INTERVALO = '30m'
 DIAS = 5
 BLOB_CONTAINER_NAME = "alerts"
 ROLLING_AVERAGE_PERIOD = 20 # Período para o cálculo da MMS (Média Móvel Simples)
+BRAPI_QUOTE_URL = "https://brapi.dev/api/quote"
+REQUEST_TIMEOUT = 30 # Timeout (segundos) das requisições à Brapi
+MAX_CONEXOES = 8 # Conexões simultâneas com a Brapi (pool HTTP e threads do fallback por ticker)
+MAX_RETRIES = 3 # Tentativas por requisição à Brapi (apenas para erros transitórios)
+MAX_BACKOFF = 8 # Espera máxima (segundos) entre tentativas; Retry-After maior que isso encerra as tentativas
+SAO_PAULO_TZ = timezone('America/Sao_Paulo')
+COLUNAS_FINAIS = ['ticker', 'datetime', 'open', 'high', 'low', 'close', 'volume', 'mms', 'status'] # Ordem do CSV
+
+# Sessão HTTP compartilhada: reaproveita a conexão TCP/TLS com a Brapi (keep-alive)
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=MAX_CONEXOES))
 
 # --- FUNÇÕES CORE ---
 
-def fetch_brapi_data(ticker: str) -> dict:
-    """Busca dados históricos de cotação para um único ticker na API Brapi."""
-    logger.info(f"Iniciando coleta para: {ticker}")
-    url = f"https://brapi.dev/api/quote/{ticker}"
+def fetch_brapi_data(tickers: list) -> tuple:
+    """Busca em uma requisição à API Brapi os dados históricos de um ou mais tickers.
+
+    Retorna (dados, falha_transitoria): falha_transitoria indica que a Brapi seguiu indisponível ou
+    limitando requisições (timeout/408/429/5xx) e que novas requisições devem ser evitadas nesta execução.
+    """
+    logger.info("Iniciando coleta para: %s", ', '.join(tickers))
+    # A Brapi aceita vários tickers separados por vírgula: um único round-trip para todos
+    url = f"{BRAPI_QUOTE_URL}/{','.join(tickers)}"
     
     # Parâmetros da API: CRÍTICO usar historical=True para pegar o OHLCV
     params = {
@@ -35,16 +58,74 @@ def fetch_brapi_data(ticker: str) -> dict:
         'historical': True
     }
     
-    try:
-        response = requests.get(url, params=params)
-        response.raise_for_status() # Lança exceção para códigos de erro HTTP
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Erro na requisição Brapi para {ticker}: {e}")
-        return {}
-
-def save_to_blob_storage(data: str, blob_name: str):
-    """Salva a string de dados como um blob no Azure Blob Storage."""
+    erro = None
+    falha_transitoria = False
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = SESSION.get(url, params=params, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e: # Timeout / falha de conexão
+            erro = e
+            espera = None
+        else:
+            # Classifica o status HTTP diretamente, sem raise_for_status()
+            status_code = response.status_code
+            if status_code < 400:
+                try:
+                    return orjson.loads(response.content), False # Decodifica direto dos bytes (mais rápido que response.json())
+                except orjson.JSONDecodeError as e:
+                    erro = e
+                    break
+            
+            erro = f"HTTP {status_code} {response.reason}"
+            # 4xx (token inválido, ticker inexistente, plano sem acesso...) não se resolve repetindo: só 408/429 e 5xx
+            if status_code not in (408, 429) and status_code < 500:
+                break
+            retry_after = response.headers.get('Retry-After', '')
+            espera = int(retry_after) if retry_after.isdigit() else None
+            # Tentar antes do prazo pedido pela Brapi só gastaria cota com novos 429:
+            # encerra as tentativas e sinaliza ao chamador para não fazer novas requisições
+            if espera is not None and espera > MAX_BACKOFF:
+                erro = f"{erro} (Retry-After: {espera}s)"
+                falha_transitoria = True
+                break
+        
+        if attempt < MAX_RETRIES - 1:
+            if espera is None:
+                # Backoff exponencial limitado, com jitter para não sincronizar novas tentativas (ex.: fallback em paralelo)
+                espera = min(2 ** attempt, MAX_BACKOFF) + random.uniform(0, 0.5)
+            logger.warning("Falha na requisição Brapi (tentativa %d/%d): %s. Nova tentativa em %.1fs.", attempt + 1, MAX_RETRIES, erro, espera)
+            time.sleep(espera)
+    else:
+        # Tentativas esgotadas em erro transitório
+        falha_transitoria = True
+    
+    logger.error("Erro na requisição Brapi para %s: %s", ', '.join(tickers), erro)
+    return {}, falha_transitoria
+
+def fetch_all_brapi_data(tickers: list) -> dict:
+    """Coleta os resultados da Brapi para todos os tickers, indexados pelo símbolo."""
+    data, falha_transitoria = fetch_brapi_data(tickers)
+    resultados = {result.get('symbol'): result for result in data.get('results', [])}
+    
+    # Com a Brapi indisponível ou limitando requisições, buscar ticker a ticker só multiplicaria as falhas
+    if falha_transitoria:
+        logger.warning("Brapi indisponível ou limitando requisições. Busca individual por ticker não executada.")
+        return resultados
+    
+    # Fallback: alguns planos da Brapi limitam a 1 ticker por requisição (erro 4xx permanente no lote)
+    # ou o lote veio incompleto. Os tickers faltantes são buscados individualmente, em paralelo (I/O-bound).
+    faltantes = [ticker for ticker in tickers if ticker not in resultados]
+    if faltantes and len(tickers) > 1:
+        logger.warning("Requisição em lote incompleta. Buscando individualmente: %s", ', '.join(faltantes))
+        with ThreadPoolExecutor(max_workers=min(len(faltantes), MAX_CONEXOES)) as executor:
+            for data_ticker, _ in executor.map(fetch_brapi_data, [[ticker] for ticker in faltantes]):
+                for result in data_ticker.get('results', []):
+                    resultados[result.get('symbol')] = result
+    
+    return resultados
+
+def save_to_blob_storage(data: io.BytesIO, blob_name: str):
+    """Salva o buffer de dados como um blob no Azure Blob Storage."""
     if not AZURE_STORAGE_CONNECTION_STRING:
         logger.error("AZURE_STORAGE_CONNECTION_STRING não configurada.")
         return
@@ -56,10 +137,43 @@ def save_to_blob_storage(data: str, blob_name: str):
             blob=blob_name
         )
         
-        blob_client.upload_blob(data, overwrite=True)
-        logger.info(f"✅ Arquivo salvo no Blob Storage: {blob_name}")
+        blob_client.upload_blob(data, overwrite=True, length=data.getbuffer().nbytes)
+        logger.info("✅ Arquivo salvo no Blob Storage: %s", blob_name)
     except Exception as e:
-        logger.error(f"Erro ao salvar no Blob Storage: {e}")
+        logger.error("Erro ao salvar no Blob Storage: %s", e)
+
+# --- LÓGICA DE ALERTA (MMS E STATUS) ---
+
+def calculate_mms(close: np.ndarray, period: int) -> np.ndarray:
+    """Calcula a MMS com rolling(period, min_periods=1).mean() do pandas (kernel em C, soma compensada)."""
+    return pd.Series(close).rolling(window=period, min_periods=1).mean().to_numpy()
+
+def calculate_alerts(group: pd.DataFrame) -> pd.DataFrame:
+    """Calcula a MMS e o status de alerta (BUY/SELL) de um ticker, retornando uma cópia com 'mms' e 'status'."""
+    # A Brapi normalmente já retorna as cotações em ordem cronológica: só ordena se necessário
+    if not group['datetime'].is_monotonic_increasing:
+        group = group.sort_values(by='datetime')
+
+    # 1. Cálculo da Média Móvel Simples (MMS)
+    close = group['close'].to_numpy(dtype=np.float64)
+    mms = calculate_mms(close, ROLLING_AVERAGE_PERIOD)
+
+    # 2. Geração do Status de Alerta (comparação vetorizada sobre arrays NumPy)
+    status = np.full(len(close), 'HOLD', dtype=object)
+
+    # Sinal de Compra (BUY): período anterior com preço <= MMS e atual com preço > MMS
+    buy_condition = (close[1:] > mms[1:]) & (close[:-1] <= mms[:-1])
+
+    # Sinal de Venda (SELL): período anterior com preço >= MMS e atual com preço < MMS
+    sell_condition = (close[1:] < mms[1:]) & (close[:-1] >= mms[:-1])
+
+    status[1:] = np.where(buy_condition, 'BUY', np.where(sell_condition, 'SELL', 'HOLD'))
+
+    # Se for a última cotação e não houver BUY/SELL, mantém como NEUTRO (melhor que HOLD)
+    if status[-1] not in ('BUY', 'SELL'):
+        status[-1] = 'NEUTRO'
+
+    return group.assign(mms=mms, status=status)
 
 def run_analysis():
     """Função principal: coleta, processa, calcula MMS e salva no Blob Storage."""
@@ -71,82 +185,67 @@ def run_analysis():
     all_data = []
     
     # 2. Coleta de Dados Históricos
+    resultados = fetch_all_brapi_data(TICKERS)
+    
     for ticker in TICKERS:
-        data = fetch_brapi_data(ticker)
+        historical_data = resultados.get(ticker, {}).get('historicalDataPrice')
         
-        # O foco é no 'historicalData', ignorando os dados de cotação atual (que não têm OHLCV por 30m)
-        if data and data.get('historicalData'):
-            df = pd.DataFrame(data['historicalData'])
-            
-            # Adiciona o ticker
-            df['ticker'] = ticker
-            
-            # --- CRÍTICO: CONVERSÃO DE TIMESTAMP PARA DATETIME ---
-            df['datetime'] = pd.to_datetime(df['date'], unit='s').dt.tz_localize(None) 
-            
-            # Renomeia colunas para o esquema que queremos
-            df = df.rename(columns={'open': 'open', 'high': 'high', 'low': 'low', 'close': 'close', 'volume': 'volume'})
-            
-            # Filtra apenas as colunas que serão usadas no cálculo
-            df = df[['ticker', 'datetime', 'open', 'high', 'low', 'close', 'volume']]
-            
-            all_data.append(df)
-        else:
-            logger.warning(f"Dados históricos vazios ou ausentes para {ticker}")
+        # O foco é no histórico OHLCV, ignorando os dados de cotação atual (que não têm OHLCV por 30m)
+        if not historical_data:
+            logger.warning("Dados históricos vazios ou ausentes para %s", ticker)
+            continue
+        
+        # Extrai do JSON apenas os campos usados, direto para arrays (sem inferir todas as chaves do payload).
+        # Campos ausentes/nulos viram NaN/NaT; valores malformados descartam apenas este ticker.
+        try:
+            datas = np.array([candle.get('date') for candle in historical_data], dtype=np.float64)
+            df = pd.DataFrame({
+                'ticker': ticker,
+                # --- CRÍTICO: CONVERSÃO DE TIMESTAMP PARA DATETIME ---
+                'datetime': pd.to_datetime(datas, unit='s'),
+                'open': np.array([candle.get('open') for candle in historical_data], dtype=np.float64),
+                'high': np.array([candle.get('high') for candle in historical_data], dtype=np.float64),
+                'low': np.array([candle.get('low') for candle in historical_data], dtype=np.float64),
+                'close': np.array([candle.get('close') for candle in historical_data], dtype=np.float64),
+                'volume': [candle.get('volume') for candle in historical_data],
+            })
+        except (TypeError, ValueError) as e:
+            logger.warning("Dados históricos inválidos para %s: %s", ticker, e)
+            continue
+        
+        # Descarta cotações sem data ou sem fechamento; só copia o DataFrame se houver alguma (caso raro)
+        cotacao_valida = (df['datetime'].notna() & df['close'].notna()).to_numpy()
+        if not cotacao_valida.all():
+            df = df[cotacao_valida]
+        
+        if df.empty:
+            logger.warning("Nenhuma cotação válida (data e fechamento) para %s", ticker)
+            continue
+        
+        # 3. Aplica a lógica de alerta no próprio ticker (evita groupby/apply sobre o DataFrame consolidado)
+        all_data.append(calculate_alerts(df))
 
     if not all_data:
         logger.error("Nenhum dado histórico coletado. Finalizando a execução.")
         return
 
-    # 3. Consolidação e Preparação do DataFrame
-    df_master = pd.concat(all_data, ignore_index=True).dropna(subset=['close'])
-
-    # --- LÓGICA DE ALERTA (MMS E STATUS) ---
-    
-    def calculate_alerts(group):
-        """Calcula a MMS e gera o status de alerta (BUY/SELL) para um grupo (ticker)."""
-        group = group.sort_values(by='datetime')
-        
-        # 1. Cálculo da Média Móvel Simples (MMS)
-        group['mms'] = group['close'].rolling(window=ROLLING_AVERAGE_PERIOD, min_periods=1).mean()
-        
-        # 2. Geração do Status de Alerta
-        group['status'] = 'HOLD'
-        
-        # Sinal de Compra (BUY)
-        buy_condition = (group['close'] > group['mms']) & (group['close'].shift(1) <= group['mms'].shift(1))
-        group.loc[buy_condition, 'status'] = 'BUY'
-        
-        # Sinal de Venda (SELL)
-        sell_condition = (group['close'] < group['mms']) & (group['close'].shift(1) >= group['mms'].shift(1))
-        group.loc[sell_condition, 'status'] = 'SELL'
-        
-        # Se for a última cotação e não houver BUY/SELL, mantém como NEUTRO (melhor que HOLD)
-        if group['status'].iloc[-1] not in ['BUY', 'SELL']:
-            group.loc[group.index[-1], 'status'] = 'NEUTRO'
-            
-        return group
-    
-    # Aplica a função de alerta para cada ticker separadamente
-    df_master = df_master.groupby('ticker').apply(calculate_alerts, include_groups=False).reset_index(drop=True)
-    
     # 4. Formato de Saída (Filtro Final CRÍTICO)
     
-    # Define as colunas finais na ORDEM correta
-    colunas_finais = ['ticker', 'datetime', 'open', 'high', 'low', 'close', 'volume', 'mms', 'status']
-    df_final = df_master[colunas_finais]
+    # Seleciona as colunas finais na ORDEM correta
+    df_final = pd.concat(all_data, ignore_index=True)[COLUNAS_FINAIS]
     
     # Nome do arquivo CSV
-    sao_paulo_tz = timezone('America/Sao_Paulo')
-    current_time_sp = datetime.now(sao_paulo_tz)
+    current_time_sp = datetime.now(SAO_PAULO_TZ)
     timestamp_str = current_time_sp.strftime("%Y-%m-%d_%H-%M-%S")
     csv_blob_name = f"analise_b3_{timestamp_str}.csv"
     
-    # Salva o DataFrame final no Blob Storage
-    csv_data = df_final.to_csv(index=False)
-    save_to_blob_storage(csv_data, csv_blob_name)
+    # Salva o DataFrame final no Blob Storage (CSV escrito direto em bytes, sem string intermediária)
+    csv_buffer = io.BytesIO()
+    df_final.to_csv(csv_buffer, index=False, encoding='utf-8')
+    csv_buffer.seek(0)
+    save_to_blob_storage(csv_buffer, csv_blob_name)
     
-    logger.info(f"✅ Análise concluída. Total de registros processados: {len(df_final)}")
+    logger.info("✅ Análise concluída. Total de registros processados: %d", len(df_final))
 
 
 # --- PONTO DE ENTRADA DO CONTAINER APP JOB ---